@@ -1,8 +1,12 @@
-from fastapi import FastAPI, HTTPException, Path, Body
-from fastapi.testclient import TestClient # To make internal HTTP calls
+from fastapi import FastAPI, HTTPException, Path, Body, Depends, Query, Request
 from pydantic import BaseModel
-from typing import List, Optional, Dict
+from typing import List, Optional, Tuple
 from enum import Enum
+from contextlib import asynccontextmanager
+import logging
+import os
+
+from store import Store, InMemoryStore, AsyncpgStore
 
 # --- Pydantic Models ---
 
@@ -33,215 +37,146 @@ class BalanceResponse(BaseModel): # Model for the response when fetching balance
     current_balance: float
     loan_details: Optional[Loan] = None # Loan details are optional
 
-# --- In-memory "Databases" (Using Dictionaries for easier lookups) ---
-users_db: Dict[int, User] = {} # Dictionary to store users (using the new User model), keyed by user_id
-loans_db: Dict[int, Loan] = {} # Dictionary to store loans, keyed by user_id for easy lookup
+logger = logging.getLogger(__name__) # Module logger; handlers come from the server's logging config
+
+# --- Error Messages (bound str.format, built once at import) ---
+_USER_NOT_FOUND = "User with ID {} not found.".format
+_USER_EXISTS = "User with ID {} already exists.".format
+_LOAN_EXISTS = "User {} already has an active loan.".format
+
+# --- Storage ---
+# Users, balances and loans live behind the Store interface (see store.py).
+# Set DATABASE_URL to share state through PostgreSQL, so the app can run with
+# several workers; otherwise everything is kept in this process's memory.
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    database_url = os.environ.get("DATABASE_URL")
+    if database_url:
+        app.state.store = await AsyncpgStore.connect(database_url)
+        yield
+        await app.state.store.close()
+    else:
+        app.state.store = InMemoryStore()
+        yield
+
+def get_store(request: Request) -> Store:
+    # Dependency that hands the configured store to an endpoint.
+    return request.app.state.store
 
 # --- FastAPI App Instance ---
 app = FastAPI(
     title="Simple Banking API (Consolidated User Model)",
     description="An API to manage users, balances, and loans, with a consolidated User model and internal calls.",
-    version="1.3.0" # Incremented version
+    version="1.3.0", # Incremented version
+    lifespan=lifespan # Sets up app.state.store
 )
 
-# --- Helper Functions (Simplified with Dicts) ---
-def find_user_by_id(user_id: int) -> Optional[User]:
-    # Retrieves a user from users_db by their ID, returns None if not found.
-    return users_db.get(user_id)
-
-def find_loan_by_user_id(user_id: int) -> Optional[Loan]:
-    # Retrieves a loan from loans_db by user_ID, returns None if not found.
-    return loans_db.get(user_id)
+# --- Helper Functions ---
+async def find_user_by_id(store: Store, user_id: int) -> Tuple[str, float]:
+    # Retrieves a user's (name, balance) by their ID, raises a 404 if not found.
+    user = await store.get_user(user_id)
+    if user is None:
+        raise HTTPException(status_code=404, detail=_USER_NOT_FOUND(user_id))
+    return user
+
+async def find_loan_by_user_id(store: Store, user_id: int) -> Optional[Loan]:
+    # Retrieves a user's loan, returns None if they don't have one.
+    amount = await store.get_loan(user_id)
+    if amount is None:
+        return None
+    return Loan.model_construct(user_id=user_id, amount=amount)
 
 # --- API Endpoints ---
 
 @app.post("/users", response_model=User, status_code=201)
-async def create_user(user_input: User = Body(...)): # Input matches User model structure
+async def create_user(
+    user_input: User = Body(...), # Input matches User model structure
+    store: Store = Depends(get_store)
+):
     # Endpoint to create a new user.
-    # user_input will have id, name, and balance (which defaults to 0.0 if not provided,
-    # but we will explicitly set it to 0.0 for new users).
-    if user_input.id in users_db: # Check if user ID already exists
-        raise HTTPException(status_code=400, detail=f"User with ID {user_input.id} already exists.")
-    
-    # Explicitly create the User object to store, ensuring balance is 0.0,
-    # regardless of what 'balance' value might have been sent in user_input.
-    new_user = User(id=user_input.id, name=user_input.name, balance=0.0)
-    
-    users_db[new_user.id] = new_user # Add the new user to the in-memory database
-    return new_user # Return the created user object (with balance 0.0)
+    # user_input will have id, name, and balance, but the store always
+    # starts new users at 0.0 regardless of what 'balance' was sent.
+    if not await store.add_user(user_input.id, user_input.name): # False if the user ID already exists
+        raise HTTPException(status_code=400, detail=_USER_EXISTS(user_input.id))
+    return User.model_construct(id=user_input.id, name=user_input.name, balance=0.0) # Return the created user (with balance 0.0)
 
 @app.post("/users/{user_id}/transaction", response_model=User)
 async def perform_transaction(
     user_id: int = Path(..., title="The ID of the user", ge=1), # User ID from path, must be >= 1
-    transaction: Transaction = Body(...) # Transaction details from request body
+    transaction: Transaction = Body(...), # Transaction details from request body
+    store: Store = Depends(get_store)
 ):
     # Endpoint to perform a debit or credit transaction for a user.
-    user = find_user_by_id(user_id) # Find the user by ID
-    if not user: # If user not found
-        raise HTTPException(status_code=404, detail=f"User with ID {user_id} not found.")
-    if transaction.amount <= 0: # Transaction amount must be positive
+    name, balance = await find_user_by_id(store, user_id) # Find the user by ID (404 if not found)
+    amount = transaction.amount
+    if amount <= 0: # Transaction amount must be positive
         raise HTTPException(status_code=400, detail="Transaction amount must be positive.")
 
+    # The funds check and the update happen in one store call, so concurrent
+    # debits can't both pass the check.
     if transaction.type == TransactionType.DEBIT: # If it's a debit transaction
-        if user.balance < transaction.amount: # Check for sufficient funds
+        balance = await store.cas_balance(user_id, -amount, min_balance=0.0)
+        if balance is None: # Not enough funds, nothing was written
             raise HTTPException(status_code=400, detail="Insufficient funds for debit.")
-        user.balance -= transaction.amount # Subtract amount from balance
     elif transaction.type == TransactionType.CREDIT: # If it's a credit transaction
-        user.balance += transaction.amount # Add amount to balance
-    users_db[user_id] = user # Update the user's record in the database
-    return user # Return the updated user object
-
-@app.post("/users/{user_id}/loan", response_model=Loan, status_code=201)
-async def take_loan(
-    user_id: int = Path(..., title="The ID of the user", ge=1), # User ID from path
-    loan_amount: float = Body(..., gt=0, embed=True, alias="amount") # Loan amount from body, must be > 0
-):
-    # Endpoint for a user to take out a loan.
-    user = find_user_by_id(user_id) # Find the user
-    if not user: # If user not found
-        raise HTTPException(status_code=404, detail=f"User with ID {user_id} not found.")
-    if find_loan_by_user_id(user_id): # Check if a loan already exists for this user
-        raise HTTPException(status_code=400, detail=f"User {user_id} already has an active loan.")
-
-    # --- INTERNAL API CALL to update balance ---
-    with TestClient(app) as client: # Create a TestClient instance for internal calls
-        transaction_payload = {"type": TransactionType.CREDIT.value, "amount": loan_amount}
-        transaction_url = f"/users/{user_id}/transaction"
-        response = client.post(transaction_url, json=transaction_payload)
-
-        if response.status_code != 200: # Check if the internal call was successful
-            error_detail = f"Failed to credit loan amount to balance. Status: {response.status_code}."
-            try:
-                error_detail += f" Detail: {response.json().get('detail', response.text)}"
-            except Exception:
-                error_detail += f" Response: {response.text}"
-            raise HTTPException(status_code=500, detail=error_detail)
-    # --- End of INTERNAL API CALL ---
-
-    new_loan = Loan(user_id=user_id, amount=loan_amount) # Create a new loan object
-    loans_db[user_id] = new_loan # Store the loan
-    return new_loan # Return the created loan object
-
-@app.get("/users/{user_id}/_internal_loan_info", response_model=Optional[Loan], include_in_schema=False)
-async def get_internal_loan_info(user_id: int = Path(..., ge=1)):
-    # Internal endpoint to fetch loan information.
-    return find_loan_by_user_id(user_id)
-
-@app.get("/users/{user_id}/balance", response_model=BalanceResponse)
-async def get_user_balance_and_loan(
-    user_id: int = Path(..., title="The ID of the user to check", ge=1) # User ID from path
-):
-    # Endpoint to get a user's balance and loan details.
-    user = find_user_by_id(user_id) # Find the user by ID
-    if not user: # If user not found
-        raise HTTPException(status_code=404, detail=f"User with ID {user_id} not found.")
-
-    loan_details: Optional[Loan] = None # Initialize loan_details
-
-    # --- INTERNAL API CALL to get loan details ---
-    with TestClient(app) as client: # Create a TestClient instance
-        internal_loan_url = f"/users/{user_id}/_internal_loan_info"
-        response = client.get(internal_loan_url) # Make the GET request
-
-        if response.status_code == 200: # If the internal call was successful
-            loan_data = response.json()
-            if loan_data: # Check if loan_data is not null
-                loan_details = Loan(**loan_data)
-        else:
-            print(f"Warning: Failed to fetch loan details internally. Status: {response.status_code}. Response: {response.text}")
-            loan_details = None # Proceed without loan details if internal call fails
-    # --- End of INTERNAL API CALL ---
-
-    return BalanceResponse(
-        user_id=user.id,
-        name=user.name, # User object now directly has name
-        current_balance=user.balance,
-        loan_details=loan_details
-    )
+        balance = await store.cas_balance(user_id, amount) # Add amount to balance
+    return User.model_construct(id=user_id, name=name, balance=balance) # Return the updated user object
 
 @app.post("/users/{user_id}/loan", response_model=Loan, status_code=201)
 async def take_loan(
     user_id: int = Path(..., title="The ID of the user", ge=1),
-    loan_amount: float = Body(..., gt=0, embed=True, alias="amount")
+    loan_amount: float = Body(..., gt=0, embed=True, alias="amount"),
+    store: Store = Depends(get_store)
 ):
-    user = find_user_by_id(user_id)
-    if not user:
-        raise HTTPException(status_code=404, detail=f"User with ID {user_id} not found.")
-    if find_loan_by_user_id(user_id):
-        raise HTTPException(status_code=400, detail=f"User {user_id} already has an active loan.")
-
-    # --- DIRECT FUNCTION CALL to update balance ---
-    transaction_to_perform = Transaction(type=TransactionType.CREDIT, amount=loan_amount)
-    try:
-        # Directly call the perform_transaction async function
-        # We need to await it as it's an async function
-        updated_user = await perform_transaction(user_id=user_id, transaction=transaction_to_perform)
-        # No need to check response.status_code, if perform_transaction fails,
-        # it will raise an HTTPException which will propagate.
-        # We can add a check on updated_user if necessary, but perform_transaction
-        # already handles its own errors by raising HTTPExceptions.
-    except HTTPException as e:
-        # If perform_transaction raised an HTTPException, we can re-raise it
-        # or wrap it in a more specific error for the loan process.
-        # For simplicity, let's propagate it, but you could customize.
-        # Example of wrapping:
-        # raise HTTPException(status_code=500, detail=f"Failed to credit loan to balance: {e.detail}")
-        raise e # Propagate the original HTTPException
-    except Exception as e:
-        # Catch any other unexpected Python errors during the direct call
-        # and convert to a generic server error.
-        error_detail = f"Unexpected error processing transaction for loan: {str(e)}"
-        raise HTTPException(status_code=500, detail=error_detail)
-    # --- End of DIRECT FUNCTION CALL ---
+    await find_user_by_id(store, user_id) # Make sure the user exists (404 if not found)
 
-    new_loan = Loan(user_id=user_id, amount=loan_amount)
-    loans_db[user_id] = new_loan
-    return new_loan
+    # Record the loan and credit the balance in a single store call, so a loan is
+    # never stored without its payout and concurrent requests can't both be paid.
+    if await store.take_loan(user_id, loan_amount) is None:
+        raise HTTPException(status_code=400, detail=_LOAN_EXISTS(user_id))
 
-@app.get("/users/{user_id}/_internal_loan_info", response_model=Optional[Loan], include_in_schema=False)
-async def get_internal_loan_info(user_id: int = Path(..., ge=1)):
-    # This function's logic remains the same, it's just called directly now.
-    # We need to ensure the user_id path parameter validation (`ge=1`) is respected
-    # if this endpoint were to be called externally. When called directly,
-    # the caller is responsible for providing a valid user_id.
-    # However, since get_user_balance_and_loan already validates its user_id,
-    # this specific direct call is relatively safe.
-    return find_loan_by_user_id(user_id)
+    return Loan.model_construct(user_id=user_id, amount=loan_amount)
 
 @app.get("/users/{user_id}/balance", response_model=BalanceResponse)
 async def get_user_balance_and_loan(
-    user_id: int = Path(..., title="The ID of the user to check", ge=1)
+    user_id: int = Path(..., title="The ID of the user to check", ge=1),
+    store: Store = Depends(get_store)
 ):
-    user = find_user_by_id(user_id)
-    if not user:
-        raise HTTPException(status_code=404, detail=f"User with ID {user_id} not found.")
+    name, balance = await find_user_by_id(store, user_id)
 
     # --- DIRECT FUNCTION CALL to get loan details ---
     try:
-        # Directly call the get_internal_loan_info async function
-        # We need to await it as it's an async function
-        loan_details: Optional[Loan] = await get_internal_loan_info(user_id=user_id)
-    except Exception as e:
-        # Handle potential errors from get_internal_loan_info, though it's unlikely
-        # in its current simple form. This is more for robust error handling.
-        print(f"Warning: Failed to fetch loan details directly. Error: {str(e)}")
+        # Plain helper call; loan info is not exposed as a route of its own
+        loan_details: Optional[Loan] = await find_loan_by_user_id(store, user_id)
+    except Exception:
+        # The store may be remote (e.g. PostgreSQL), so a failed lookup
+        # degrades to a response without loan details instead of a 500.
+        logger.warning("Failed to fetch loan details for user %s", user_id, exc_info=True)
         loan_details = None # Proceed without loan details if direct call fails
     # --- End of DIRECT FUNCTION CALL ---
 
-    return BalanceResponse(
-        user_id=user.id,
-        name=user.name,
-        current_balance=user.balance,
+    return BalanceResponse.model_construct(
+        user_id=user_id,
+        name=name,
+        current_balance=balance,
         loan_details=loan_details
     )
 
 
 @app.get("/users", response_model=List[User], tags=["Admin"]) # response_model uses the new User
-async def get_all_users():
-    # Endpoint to retrieve a list of all users.
-    return list(users_db.values())
+async def get_all_users(
+    limit: int = Query(100, ge=0), # Page size
+    offset: int = Query(0, ge=0), # Number of users to skip
+    store: Store = Depends(get_store)
+):
+    # Endpoint to retrieve a page of users.
+    return [User.model_construct(id=uid, name=name, balance=balance) for uid, name, balance in await store.list_users(limit, offset)]
 
 @app.get("/loans", response_model=List[Loan], tags=["Admin"])
-async def get_all_loans():
-    # Endpoint to retrieve a list of all active loans.
-    return list(loans_db.values())
+async def get_all_loans(
+    limit: int = Query(100, ge=0), # Page size
+    offset: int = Query(0, ge=0), # Number of loans to skip
+    store: Store = Depends(get_store)
+):
+    # Endpoint to retrieve a page of active loans.
+    return [Loan.model_construct(user_id=uid, amount=amount) for uid, amount in await store.list_loans(limit, offset)]
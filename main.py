@@ -1,7 +1,15 @@
-from fastapi import FastAPI, HTTPException, Path, Body
+from fastapi import FastAPI, HTTPException, Path, Body, Header, Query, Response
 from pydantic import BaseModel
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Tuple
 from enum import Enum
+from collections import OrderedDict
+from itertools import chain, islice
+import array
+import hashlib
+import logging
+import operator
+import threading
+import orjson
 
 class User(BaseModel):
     id: int
@@ -16,6 +24,8 @@ class TransactionType(str, Enum):
     DEBIT = "debit"
     CREDIT = "credit"
 
+_BALANCE_OPS = {TransactionType.DEBIT: operator.sub, TransactionType.CREDIT: operator.add}
+
 class Transaction(BaseModel):
     type: TransactionType
     amount: float
@@ -26,98 +36,205 @@ class BalanceResponse(BaseModel):
     current_balance: float
     loan_details: Optional[Loan] = None
 
-users_db: Dict[int, User] = {}
+# Users with small, roughly sequential IDs are stored by index (_names[id],
+# _balances[id]); anything else falls back to the sparse dicts. A None name marks
+# an unused dense slot. The columns only grow while they stay within
+# 2 * dense users + DENSE_SLACK slots, so widely spaced IDs can't inflate them.
+DENSE_SLACK = 128
+_names: List[Optional[str]] = []
+_balances = array.array("d")
+_dense_count = 0
+user_names: Dict[int, str] = {}
+user_balances: Dict[int, float] = {}
+_create_guard = threading.Lock()
 loans_db: Dict[int, Loan] = {}
 
-app = FastAPI()
+LOCK_STRIPES = 64
+_balance_locks = tuple(threading.Lock() for _ in range(LOCK_STRIPES))
 
-def find_user_by_id(user_id: int) -> Optional[User]:
-    return users_db.get(user_id)
+BALANCE_CACHE_SIZE = 1024
+_balance_version: Dict[int, int] = {}
+_balance_cache: "OrderedDict[Tuple[int, int], Tuple[str, bytes]]" = OrderedDict()
+_balance_cache_guard = threading.Lock()
 
-def find_loan_by_user_id(user_id: int) -> Optional[Loan]:
-    return loans_db.get(user_id)
+_USER_NOT_FOUND = "User with ID {} not found.".format
+_USER_EXISTS = "User with ID {} already exists.".format
+_LOAN_EXISTS = "User {} already has an active loan.".format
+
+logger = logging.getLogger(__name__)
+
+app = FastAPI()
+
+def _is_dense(user_id: int) -> bool:
+    return 0 <= user_id < len(_names) and _names[user_id] is not None
+
+def find_user_by_id(user_id: int) -> Tuple[str, float]:
+    # Runs on every request, so the dense check is inlined rather than calling _is_dense.
+    if 0 <= user_id < len(_names):
+        name = _names[user_id]
+        if name is not None:
+            return name, _balances[user_id]
+    name = user_names.get(user_id)
+    if name is None:
+        raise HTTPException(status_code=404, detail=_USER_NOT_FOUND(user_id))
+    return name, user_balances[user_id]
+
+def _lock_for(user_id: int) -> threading.Lock:
+    # Endpoints run on the threadpool, so the balance check-then-write needs a lock.
+    # A fixed set of stripes keeps unrelated users mostly apart without allocating
+    # or looking up a lock per user on the uncontended path.
+    return _balance_locks[user_id % LOCK_STRIPES]
+
+def _bump_balance_version(user_id: int) -> None:
+    # Call with _lock_for(user_id) held, after the write it invalidates.
+    _balance_version[user_id] = _balance_version.get(user_id, 0) + 1
 
 @app.post("/users", response_model=User, status_code=201)
-async def create_user(user_input: User = Body(...)):
-    if user_input.id in users_db:
-        raise HTTPException(status_code=400, detail=f"User with ID {user_input.id} already exists.")
-    new_user = User(id=user_input.id, name=user_input.name, balance=0.0)
-    users_db[new_user.id] = new_user
-    return new_user
+def create_user(user_input: User = Body(...)):
+    global _dense_count
+    user_id = user_input.id
+    with _create_guard:
+        if _is_dense(user_id) or user_id in user_names:
+            raise HTTPException(status_code=400, detail=_USER_EXISTS(user_id))
+        # Balances are written before names so a reader that sees the name always finds the balance.
+        if 0 <= user_id and (user_id < len(_names) or user_id < 2 * (_dense_count + 1) + DENSE_SLACK):
+            gap = user_id + 1 - len(_names)
+            if gap > 0:
+                _balances.extend([0.0] * gap)
+                _names.extend([None] * gap)
+            _balances[user_id] = 0.0
+            _names[user_id] = user_input.name
+            _dense_count += 1
+        else:
+            user_balances[user_id] = 0.0
+            user_names[user_id] = user_input.name
+    return User.model_construct(id=user_input.id, name=user_input.name, balance=0.0)
+
+def _apply_transaction(user_id: int, name: str, transaction: Transaction) -> User:
+    # The caller has already looked the user up; users are never removed, so the
+    # balance is read fresh under the lock without a second existence check.
+    amount = transaction.amount
+    if amount <= 0:
+        raise HTTPException(status_code=400, detail="Transaction amount must be positive.")
+    is_debit = transaction.type is TransactionType.DEBIT
+    op = _BALANCE_OPS[transaction.type]
+    dense = _is_dense(user_id)
+
+    # Only the read-check-write of the balance is held under the lock.
+    with _lock_for(user_id):
+        balance = _balances[user_id] if dense else user_balances[user_id]
+        if is_debit and balance < amount:
+            raise HTTPException(status_code=400, detail="Insufficient funds for debit.")
+        balance = op(balance, amount)
+        if dense:
+            _balances[user_id] = balance
+        else:
+            user_balances[user_id] = balance
+        _bump_balance_version(user_id)
+    return User.model_construct(id=user_id, name=name, balance=balance)
 
 @app.post("/users/{user_id}/transaction", response_model=User)
-async def perform_transaction(
+def perform_transaction(
     user_id: int = Path(..., title="The ID of the user", ge=1),
     transaction: Transaction = Body(...)
 ):
-    user = find_user_by_id(user_id)
-    if not user:
-        raise HTTPException(status_code=404, detail=f"User with ID {user_id} not found.")
-    if transaction.amount <= 0:
-        raise HTTPException(status_code=400, detail="Transaction amount must be positive.")
-
-    if transaction.type == TransactionType.DEBIT:
-        if user.balance < transaction.amount:
-            raise HTTPException(status_code=400, detail="Insufficient funds for debit.")
-        user.balance -= transaction.amount
-    elif transaction.type == TransactionType.CREDIT:
-        user.balance += transaction.amount
-    users_db[user_id] = user
-    return user
+    name, _ = find_user_by_id(user_id)
+    return _apply_transaction(user_id, name, transaction)
 
 @app.post("/users/{user_id}/loan", response_model=Loan, status_code=201)
-async def take_loan(
+def take_loan(
     user_id: int = Path(..., title="The ID of the user", ge=1),
     loan_amount: float = Body(..., gt=0, embed=True, alias="amount")
 ):
-    user = find_user_by_id(user_id)
-    if not user:
-        raise HTTPException(status_code=404, detail=f"User with ID {user_id} not found.")
-    if find_loan_by_user_id(user_id):
-        raise HTTPException(status_code=400, detail=f"User {user_id} already has an active loan.")
+    name, _ = find_user_by_id(user_id)
+
+    # Claim the loan before crediting so concurrent requests can't both be paid out.
+    new_loan = Loan.model_construct(user_id=user_id, amount=loan_amount)
+    with _lock_for(user_id):
+        if user_id in loans_db:
+            raise HTTPException(status_code=400, detail=_LOAN_EXISTS(user_id))
+        loans_db[user_id] = new_loan
 
-    transaction_to_perform = Transaction(type=TransactionType.CREDIT, amount=loan_amount)
+    transaction_to_perform = Transaction.model_construct(type=TransactionType.CREDIT, amount=loan_amount)
     try:
-        updated_user = await perform_transaction(user_id=user_id, transaction=transaction_to_perform)
-    except HTTPException as e:
-        raise e
+        updated_user = _apply_transaction(user_id, name, transaction_to_perform)
     except Exception as e:
+        with _lock_for(user_id):
+            del loans_db[user_id]
+            _bump_balance_version(user_id)
+        if isinstance(e, HTTPException):
+            raise e
         error_detail = f"Unexpected error processing transaction for loan: {str(e)}"
         raise HTTPException(status_code=500, detail=error_detail)
-
-    new_loan = Loan(user_id=user_id, amount=loan_amount)
-    loans_db[user_id] = new_loan
     return new_loan
 
-@app.get("/users/{user_id}/_internal_loan_info", response_model=Optional[Loan], include_in_schema=False)
-async def get_internal_loan_info(user_id: int = Path(..., ge=1)):
-    return find_loan_by_user_id(user_id)
+def _get_loan_info_sync(user_id: int) -> Optional[Loan]:
+    return loans_db.get(user_id)
+
+def _etag_matches(etag: str, if_none_match: Optional[str]) -> bool:
+    if not if_none_match:
+        return False
+    return any(tag == "*" or tag.removeprefix("W/") == etag for tag in map(str.strip, if_none_match.split(",")))
+
+def _balance_response(etag: str, body: bytes, if_none_match: Optional[str]) -> Response:
+    # no-cache lets clients keep the body but revalidate it with If-None-Match on every use.
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if _etag_matches(etag, if_none_match):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
 @app.get("/users/{user_id}/balance", response_model=BalanceResponse)
-async def get_user_balance_and_loan(
-    user_id: int = Path(..., title="The ID of the user to check", ge=1)
+def get_user_balance_and_loan(
+    user_id: int = Path(..., title="The ID of the user to check", ge=1),
+    if_none_match: Optional[str] = Header(None)
 ):
-    user = find_user_by_id(user_id)
-    if not user:
-        raise HTTPException(status_code=404, detail=f"User with ID {user_id} not found.")
+    # Read the version before the data so a concurrent write can only make the
+    # cached body newer than its key, never older.
+    key = (user_id, _balance_version.get(user_id, 0))
+    with _balance_cache_guard:
+        entry = _balance_cache.get(key)
+        if entry is not None:
+            _balance_cache.move_to_end(key)
+    if entry is not None:
+        return _balance_response(*entry, if_none_match)
+
+    name, balance = find_user_by_id(user_id)
 
     try:
-        loan_details: Optional[Loan] = await get_internal_loan_info(user_id=user_id)
-    except Exception as e:
-        print(f"Warning: Failed to fetch loan details directly. Error: {str(e)}")
+        loan_details = _get_loan_info_sync(user_id)
+    except Exception:
+        logger.warning("Failed to fetch loan details for user %s", user_id, exc_info=True)
         loan_details = None
+        key = None # Don't cache a response that is missing its loan details
 
-    return BalanceResponse(
-        user_id=user.id,
-        name=user.name,
-        current_balance=user.balance,
+    body = BalanceResponse.model_construct(
+        user_id=user_id,
+        name=name,
+        current_balance=balance,
         loan_details=loan_details
-    )
+    ).model_dump_json().encode()
+    # Content-derived so the tag stays valid across restarts and between workers.
+    etag = '"%s"' % hashlib.blake2b(body, digest_size=16).hexdigest()
+    if key is not None:
+        with _balance_cache_guard:
+            _balance_cache[key] = (etag, body)
+            if len(_balance_cache) > BALANCE_CACHE_SIZE:
+                _balance_cache.popitem(last=False)
+    return _balance_response(etag, body, if_none_match)
 
 @app.get("/users", response_model=List[User])
-async def get_all_users():
-    return list(users_db.values())
+def get_all_users(limit: int = Query(100, ge=0), offset: int = Query(0, ge=0)):
+    users = chain(
+        ((uid, name, _balances[uid]) for uid, name in enumerate(_names) if name is not None),
+        ((uid, name, user_balances[uid]) for uid, name in user_names.items()),
+    )
+    # Held so create_user can't resize user_names while the page is being read lazily.
+    with _create_guard:
+        payload = [{"id": uid, "name": name, "balance": balance} for uid, name, balance in islice(users, offset, offset + limit)]
+    return Response(content=orjson.dumps(payload), media_type="application/json")
 
 @app.get("/loans", response_model=List[Loan])
-async def get_all_loans():
-    return list(loans_db.values())
\ No newline at end of file
+def get_all_loans(limit: int = Query(100, ge=0), offset: int = Query(0, ge=0)):
+    page = list(islice(loans_db.values(), offset, offset + limit))
+    payload = [{"user_id": loan.user_id, "amount": loan.amount} for loan in page]
+    return Response(content=orjson.dumps(payload), media_type="application/json")
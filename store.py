@@ -0,0 +1,172 @@
+from itertools import islice
+from typing import Dict, List, Optional, Protocol, Tuple
+
+class Store(Protocol):
+    # Backing store for users, balances and loans. Every method is a single atomic
+    # operation, so handlers never need their own read-check-write across an await.
+
+    async def get_user(self, user_id: int) -> Optional[Tuple[str, float]]:
+        # Returns (name, balance), or None if the user does not exist.
+        ...
+
+    async def add_user(self, user_id: int, name: str) -> bool:
+        # Inserts a user with a zero balance; False if the ID is already taken.
+        ...
+
+    async def cas_balance(self, user_id: int, delta: float, min_balance: Optional[float] = None) -> Optional[float]:
+        # Adds delta to the balance and returns the new balance. If min_balance is given
+        # and the result would fall below it, nothing is written and None is returned.
+        ...
+
+    async def get_loan(self, user_id: int) -> Optional[float]:
+        ...
+
+    async def take_loan(self, user_id: int, amount: float) -> Optional[float]:
+        # Records a loan and credits it to the balance as one atomic step, returning
+        # the new balance. None if the user already has a loan; nothing is written.
+        ...
+
+    async def list_users(self, limit: int, offset: int = 0) -> List[Tuple[int, str, float]]:
+        ...
+
+    async def list_loans(self, limit: int, offset: int = 0) -> List[Tuple[int, float]]:
+        ...
+
+class InMemoryStore:
+    # Single-process store. No method awaits, so each one runs to completion on the
+    # event loop without interleaving.
+
+    def __init__(self) -> None:
+        self.user_names: Dict[int, str] = {}
+        self.user_balances: Dict[int, float] = {}
+        self.loans: Dict[int, float] = {}
+
+    async def get_user(self, user_id: int) -> Optional[Tuple[str, float]]:
+        name = self.user_names.get(user_id)
+        if name is None:
+            return None
+        return name, self.user_balances[user_id]
+
+    async def add_user(self, user_id: int, name: str) -> bool:
+        if user_id in self.user_names:
+            return False
+        self.user_balances[user_id] = 0.0
+        self.user_names[user_id] = name
+        return True
+
+    async def cas_balance(self, user_id: int, delta: float, min_balance: Optional[float] = None) -> Optional[float]:
+        balance = self.user_balances[user_id] + delta
+        if min_balance is not None and balance < min_balance:
+            return None
+        self.user_balances[user_id] = balance
+        return balance
+
+    async def get_loan(self, user_id: int) -> Optional[float]:
+        return self.loans.get(user_id)
+
+    async def take_loan(self, user_id: int, amount: float) -> Optional[float]:
+        if user_id in self.loans:
+            return None
+        self.loans[user_id] = amount
+        balance = self.user_balances[user_id] + amount
+        self.user_balances[user_id] = balance
+        return balance
+
+    async def list_users(self, limit: int, offset: int = 0) -> List[Tuple[int, str, float]]:
+        page = islice(self.user_names.items(), offset, offset + limit)
+        return [(uid, name, self.user_balances[uid]) for uid, name in page]
+
+    async def list_loans(self, limit: int, offset: int = 0) -> List[Tuple[int, float]]:
+        return list(islice(self.loans.items(), offset, offset + limit))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id BIGINT PRIMARY KEY,
+    name TEXT NOT NULL,
+    balance DOUBLE PRECISION NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS loans (
+    user_id BIGINT PRIMARY KEY REFERENCES users (id),
+    amount DOUBLE PRECISION NOT NULL
+);
+"""
+# Arbitrary key for pg_advisory_xact_lock; serialises schema setup across workers.
+_SCHEMA_LOCK_KEY = 0x62616E6B
+
+class AsyncpgStore:
+    # PostgreSQL store shared by every worker process. Each method is one statement,
+    # so balance updates are atomic without application-side locking.
+
+    def __init__(self, pool) -> None:
+        self._pool = pool
+
+    @classmethod
+    async def connect(cls, dsn: str) -> "AsyncpgStore":
+        import asyncpg # Only needed when a database is configured
+
+        pool = await asyncpg.create_pool(dsn)
+        # Concurrent CREATE TABLE IF NOT EXISTS can still fail with a unique violation
+        # in Postgres, so workers starting together take turns under an advisory lock.
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("SELECT pg_advisory_xact_lock($1)", _SCHEMA_LOCK_KEY)
+                await conn.execute(_SCHEMA)
+        return cls(pool)
+
+    async def close(self) -> None:
+        await self._pool.close()
+
+    async def get_user(self, user_id: int) -> Optional[Tuple[str, float]]:
+        row = await self._pool.fetchrow("SELECT name, balance FROM users WHERE id = $1", user_id)
+        if row is None:
+            return None
+        return row["name"], row["balance"]
+
+    async def add_user(self, user_id: int, name: str) -> bool:
+        inserted = await self._pool.fetchval(
+            "INSERT INTO users (id, name) VALUES ($1, $2) ON CONFLICT (id) DO NOTHING RETURNING id",
+            user_id, name,
+        )
+        return inserted is not None
+
+    async def cas_balance(self, user_id: int, delta: float, min_balance: Optional[float] = None) -> Optional[float]:
+        if min_balance is None:
+            return await self._pool.fetchval(
+                "UPDATE users SET balance = balance + $1 WHERE id = $2 RETURNING balance",
+                delta, user_id,
+            )
+        return await self._pool.fetchval(
+            "UPDATE users SET balance = balance + $1 WHERE id = $2 AND balance + $1 >= $3 RETURNING balance",
+            delta, user_id, min_balance,
+        )
+
+    async def get_loan(self, user_id: int) -> Optional[float]:
+        return await self._pool.fetchval("SELECT amount FROM loans WHERE user_id = $1", user_id)
+
+    async def take_loan(self, user_id: int, amount: float) -> Optional[float]:
+        # One statement, so the loan row and the credit commit or roll back together.
+        return await self._pool.fetchval(
+            """
+            WITH loan AS (
+                INSERT INTO loans (user_id, amount) VALUES ($1, $2)
+                ON CONFLICT (user_id) DO NOTHING
+                RETURNING user_id
+            )
+            UPDATE users SET balance = users.balance + $2
+            FROM loan WHERE users.id = loan.user_id
+            RETURNING users.balance
+            """,
+            user_id, amount,
+        )
+
+    async def list_users(self, limit: int, offset: int = 0) -> List[Tuple[int, str, float]]:
+        rows = await self._pool.fetch(
+            "SELECT id, name, balance FROM users ORDER BY id LIMIT $1 OFFSET $2", limit, offset
+        )
+        return [(row["id"], row["name"], row["balance"]) for row in rows]
+
+    async def list_loans(self, limit: int, offset: int = 0) -> List[Tuple[int, float]]:
+        rows = await self._pool.fetch(
+            "SELECT user_id, amount FROM loans ORDER BY user_id LIMIT $1 OFFSET $2", limit, offset
+        )
+        return [(row["user_id"], row["amount"]) for row in rows]